@@ -1,25 +1,38 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, Response
+from fastapi.responses import ORJSONResponse, FileResponse, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Deque, Union
+from collections import deque
 import socketio
 import asyncio
-import json
+import csv
+import io
 import uuid
 from datetime import datetime
 import logging
 import os
 import aiofiles
+import httpx
+import orjson
 from pathlib import Path
 import base64
+import hmac
 import pytz
 
+from wal import WriteAheadLog
+
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# デバッグモード（Socket.IO / Engine.IO のパケット単位のログを出力する）
+DEBUG = os.getenv("TSG_DEBUG") == "1"
+if not DEBUG:
+    logging.getLogger('socketio').setLevel(logging.WARNING)
+    logging.getLogger('engineio').setLevel(logging.WARNING)
+
 # 日本時間のタイムゾーン
 JST = pytz.timezone('Asia/Tokyo')
 
@@ -27,16 +40,49 @@ JST = pytz.timezone('Asia/Tokyo')
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 
+# Socket.IO のパケットをorjsonでエンコード・デコードする
+# （ルーム宛の送信ではパケットは1回だけエンコードされ、全員に同じものが送られる）
+class OrjsonCodec:
+    @staticmethod
+    def dumps(obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
 # Socket.IO サーバー設定
 sio = socketio.AsyncServer(
     cors_allowed_origins="*",
     async_mode='asgi',
-    logger=True,
-    engineio_logger=True
+    logger=DEBUG,
+    engineio_logger=DEBUG,
+    json=OrjsonCodec
 )
 
+# ルームごとの参加クライアント（誰もいないルームへの送信を省略するため）
+room_sids: Dict[str, set] = {}
+# クライアントごとの参加ルーム（切断時に該当ルームだけを片付けるための逆引き）
+sid_rooms: Dict[str, set] = {}
+
+def track_room(sid: str, room: str):
+    """ルームへの参加を記録"""
+    room_sids.setdefault(room, set()).add(sid)
+    sid_rooms.setdefault(sid, set()).add(room)
+
+async def emit_to_room(event: str, data: Any, room: Union[str, List[str]]):
+    """ルームに参加者がいる場合のみ送信（複数ルームを指定すると1回の送信でまとめて配信）"""
+    rooms = [r for r in ([room] if isinstance(room, str) else room) if room_sids.get(r)]
+    if not rooms:
+        return
+    await sio.emit(event, data, room=rooms if len(rooms) > 1 else rooms[0])
+
+def instance_rooms(instance_id: str) -> List[str]:
+    """一般ユーザー用と管理者用のルーム"""
+    return [instance_id, f"admin_{instance_id}"]
+
 # FastAPI アプリケーション
-app = FastAPI(title="TSG Comment API", version="1.0.0")
+app = FastAPI(title="TSG Comment API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS設定
 app.add_middleware(
@@ -50,12 +96,102 @@ app.add_middleware(
 # Socket.IO アプリケーション
 socket_app = socketio.ASGIApp(sio, app)
 
+# 新着コメントの配信（短い間隔でまとめてルームごとに1回だけ送信する）
+class CommentBroadcaster:
+    def __init__(self, window: float = 0.01):
+        self.window = window  # まとめて配信するまでの待ち時間（秒）
+        self.pending: Dict[str, List[Dict]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def add(self, instance_id: str, comment: Dict):
+        """配信待ちに追加"""
+        self.pending.setdefault(instance_id, []).append(comment)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.window)
+            await self.flush()
+
+    async def flush(self):
+        """配信待ちのコメントを一般ユーザー用と管理者用のルームに送信"""
+        if self._wakeup is not None:
+            self._wakeup.clear()
+        batch, self.pending = self.pending, {}
+        for instance_id, comments in batch.items():
+            try:
+                await emit_to_room('new_comments', comments, instance_rooms(instance_id))
+            except Exception as e:
+                logger.error(f"コメント配信エラー: {e}")
+
+broadcaster = CommentBroadcaster()
+
+# Webhook通知用のHTTPクライアント（接続を使い回す）
+webhook_client = httpx.AsyncClient(timeout=5.0, limits=httpx.Limits(max_keepalive_connections=32))
+
+async def send_webhook(url: str, comment_data: Dict):
+    """新しいコメントをWebhook URLに通知（失敗してもコメント投稿には影響させない）"""
+    try:
+        response = await webhook_client.post(
+            url,
+            content=orjson.dumps({"type": "new_comment", "data": comment_data}),
+            headers={"Content-Type": "application/json"}
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        logger.warning(f"Webhook通知エラー: {url}: {e}")
+
 # データストレージ（JSONファイルベース永続化）
+# 変更はWALに追記し、定期的にスナップショット（各JSONファイル）へまとめて書き出す
+SNAPSHOT_INTERVAL = 30  # スナップショット間隔（秒）
+DEFAULT_HISTORY_LIMIT = 10000  # インスタンスごとに保持するコメント数の既定値
+
+def _insert_by_timestamp(comments: Deque[Dict], comment: Dict):
+    """タイムスタンプ順を保ったままコメントを挿入（二分探索）"""
+    lo, hi = 0, len(comments)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if comments[mid]["timestamp"] <= comment["timestamp"]:
+            lo = mid + 1
+        else:
+            hi = mid
+    comments.insert(lo, comment)
+
 class DataStore:
     def __init__(self):
         self.instances: Dict[str, Dict] = {}
-        self.comments: Dict[str, List[Dict]] = {}
+        # 上限を超えると古いものから破棄されるリングバッファ
+        self.comments: Dict[str, Deque[Dict]] = {}
         self.settings: Dict[str, Dict] = {}
+        # HTTPレスポンス用にエンコード済みの設定（更新時に破棄し、次の読み出しで一度だけ作り直す）
+        self._settings_json: Dict[str, bytes] = {}
+        # エクスポート用にエンコード済みのコメント（"csv" / "json"、コメントが変わったら破棄）
+        self.export_cache: Dict[str, Dict[str, bytes]] = {}
+        # 管理画面のAuthorizationヘッダーの期待値（保存対象外、読み込み時・作成時に作成）
+        self.auth_tokens: Dict[str, Optional[bytes]] = {}
+        # 非表示でないコメントのキャッシュ（作成・非表示・再表示のたびに差分更新）
+        self.visible_comments: Dict[str, Deque[Dict]] = {}
+        # コメントIDからコメントを引くための索引（インスタンスID → コメントID → コメント）
+        self.comment_index: Dict[str, Dict[str, Dict]] = {}
+        self.wal = WriteAheadLog(DATA_DIR / "wal.log")
+        self._snapshot_task: Optional[asyncio.Task] = None
         self.load_data()
         
     def load_data(self):
@@ -64,74 +200,313 @@ class DataStore:
             # インスタンスデータを読み込み
             instances_file = DATA_DIR / "instances.json"
             if instances_file.exists():
-                with open(instances_file, 'r', encoding='utf-8') as f:
-                    self.instances = json.load(f)
+                with open(instances_file, 'rb') as f:
+                    self.instances = orjson.loads(f.read())
             
             # コメントデータを読み込み
             comments_file = DATA_DIR / "comments.json"
             if comments_file.exists():
-                with open(comments_file, 'r', encoding='utf-8') as f:
-                    self.comments = json.load(f)
+                with open(comments_file, 'rb') as f:
+                    self.comments = {
+                        instance_id: deque(comments, maxlen=self._history_limit(instance_id))
+                        for instance_id, comments in orjson.loads(f.read()).items()
+                    }
             
             # 設定データを読み込み
             settings_file = DATA_DIR / "settings.json"
             if settings_file.exists():
-                with open(settings_file, 'r', encoding='utf-8') as f:
-                    self.settings = json.load(f)
+                with open(settings_file, 'rb') as f:
+                    self.settings = orjson.loads(f.read())
+            
+            self.visible_comments = {
+                instance_id: self._filter_visible(comments)
+                for instance_id, comments in self.comments.items()
+            }
+            self.comment_index = {
+                instance_id: {c["id"]: c for c in comments}
+                for instance_id, comments in self.comments.items()
+            }
+            
+            self.auth_tokens = {
+                instance_id: self._auth_token(instance)
+                for instance_id, instance in self.instances.items()
+            }
+            
+            # スナップショット以降の変更をWALから再生
+            # （スナップショット書き出し直後に停止した場合に備え、既存コメントは重複させない）
+            events = self.wal.replay()
+            for event in events:
+                if event["op"] == "new_comment":
+                    comment = event["comment"]
+                    if comment["id"] in self.comment_index.get(comment["instance_id"], {}):
+                        continue
+                self._apply(event)
                     
-            logger.info(f"データを読み込みました: インスタンス{len(self.instances)}個, コメント{sum(len(comments) for comments in self.comments.values())}個")
+            logger.info(f"データを読み込みました: インスタンス{len(self.instances)}個, コメント{sum(len(comments) for comments in self.comments.values())}個, WALイベント{len(events)}件")
         except Exception as e:
             logger.error(f"データ読み込みエラー: {e}")
     
-    def save_data(self):
-        """データを保存"""
+    async def save_data(self):
+        """データを保存（一時ファイルに書いてから置き換える）"""
         try:
-            # インスタンスデータを保存
-            with open(DATA_DIR / "instances.json", 'w', encoding='utf-8') as f:
-                json.dump(self.instances, f, ensure_ascii=False, indent=2)
-            
-            # コメントデータを保存
-            with open(DATA_DIR / "comments.json", 'w', encoding='utf-8') as f:
-                json.dump(self.comments, f, ensure_ascii=False, indent=2)
-            
-            # 設定データを保存
-            with open(DATA_DIR / "settings.json", 'w', encoding='utf-8') as f:
-                json.dump(self.settings, f, ensure_ascii=False, indent=2)
+            # 書き込み中に変更が入っても一貫した状態を保存できるよう、先にすべてシリアライズする
+            files = {
+                "instances.json": orjson.dumps(self.instances, option=orjson.OPT_NON_STR_KEYS),
+                "comments.json": orjson.dumps({k: list(v) for k, v in self.comments.items()}, option=orjson.OPT_NON_STR_KEYS),
+                "settings.json": orjson.dumps(self.settings, option=orjson.OPT_NON_STR_KEYS),
+            }
+            for filename, content in files.items():
+                tmp_path = DATA_DIR / f"{filename}.tmp"
+                async with aiofiles.open(tmp_path, 'wb') as f:
+                    await f.write(content)
+                    await f.flush()
+                    await asyncio.to_thread(os.fsync, f.fileno())
+                os.replace(tmp_path, DATA_DIR / filename)
                 
             logger.info("データを保存しました")
         except Exception as e:
             logger.error(f"データ保存エラー: {e}")
+            raise
+
+    async def start(self):
+        """WALの書き込みと定期スナップショットを開始"""
+        await self.wal.start()
+        self._snapshot_task = asyncio.create_task(self._run_snapshots())
+
+    async def stop(self):
+        """定期スナップショットを止め、最終スナップショットを書き出す"""
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            try:
+                await self._snapshot_task
+            except asyncio.CancelledError:
+                pass
+            self._snapshot_task = None
+        await self.wal.checkpoint(self.save_data)
+        await self.wal.close()
+
+    async def _run_snapshots(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                await self.wal.checkpoint(self.save_data)
+            except Exception as e:
+                logger.error(f"スナップショットエラー: {e}")
+
+    def _history_limit(self, instance_id: str) -> int:
+        return self.instances.get(instance_id, {}).get("history_limit", DEFAULT_HISTORY_LIMIT)
+
+    @staticmethod
+    def _auth_token(instance: Dict) -> Optional[bytes]:
+        """ユーザー名なし・パスワードのみのBasic認証ヘッダー（パスワード未設定ならNone）"""
+        admin_password = instance.get("admin_password")
+        if not admin_password:
+            return None
+        return b"Basic " + base64.b64encode(b":" + admin_password.encode("utf-8"))
+
+    @staticmethod
+    def _filter_visible(comments: Deque[Dict]) -> Deque[Dict]:
+        return deque(c for c in comments if not c.get('hidden', False))
+
+    def _apply(self, event: Dict) -> Optional[Dict]:
+        """変更イベントをメモリ上のデータに反映（WAL再生でも使用する）"""
+        op = event["op"]
+        if op == "create_instance":
+            instance_id = event["instance"]["id"]
+            self.instances[instance_id] = event["instance"]
+            self.auth_tokens[instance_id] = self._auth_token(event["instance"])
+            self.comments.setdefault(instance_id, deque(maxlen=self._history_limit(instance_id)))
+            self.visible_comments.setdefault(instance_id, deque())
+            self.comment_index.setdefault(instance_id, {})
+            self.settings.setdefault(instance_id, event["settings"])
+            self._settings_json.pop(instance_id, None)
+            self.export_cache.pop(instance_id, None)
+            return self.instances[instance_id]
         
-    def create_instance(self, instance_id: str, name: str, webhook_url: Optional[str] = None, admin_password: Optional[str] = None):
-        self.instances[instance_id] = {
-            "id": instance_id,
-            "name": name,
-            "webhook_url": webhook_url,
-            "admin_password": admin_password,
-            "created_at": datetime.now(JST).isoformat(),
-            "active": True
-        }
-        self.comments[instance_id] = []
-        self.settings[instance_id] = {
-            "background_color": "#00FF00",
-            "text_color": "#000000",
-            "font_size": 16,
-            "max_comments": 50,
-            "auto_scroll": True,
-            "show_timestamp": True,
-            "moderation_enabled": False,
-            "comment_width": 400,
-            "comment_height": 120,
-            "background_opacity": 30,
-            "text_opacity": 100,
-            "comment_background_color": "#FFFFFF",
-            "lag_seconds": 0
+        if op == "delete_instance":
+            instance_id = event["instance_id"]
+            self.instances.pop(instance_id, None)
+            self.auth_tokens.pop(instance_id, None)
+            self.comments.pop(instance_id, None)
+            self.visible_comments.pop(instance_id, None)
+            self.comment_index.pop(instance_id, None)
+            self.settings.pop(instance_id, None)
+            self._settings_json.pop(instance_id, None)
+            self.export_cache.pop(instance_id, None)
+            return None
+        
+        if op == "new_comment":
+            comment = event["comment"]
+            instance_id = comment["instance_id"]
+            comments = self.comments.setdefault(instance_id, deque(maxlen=self._history_limit(instance_id)))
+            visible = self.visible_comments.setdefault(instance_id, deque())
+            index = self.comment_index.setdefault(instance_id, {})
+            if len(comments) == comments.maxlen:
+                # 最も古いコメントが押し出されるので表示中キャッシュと索引からも外す
+                evicted = comments[0]
+                index.pop(evicted["id"], None)
+                if not evicted.get("hidden", False):
+                    if visible[0] is evicted:
+                        visible.popleft()
+                    else:
+                        visible.remove(evicted)
+            comments.append(comment)
+            index[comment["id"]] = comment
+            self.export_cache.pop(instance_id, None)
+            if not comment.get("hidden", False):
+                visible.append(comment)
+            return comment
+        
+        if op in ("hide_comment", "show_comment"):
+            instance_id = event["instance_id"]
+            hidden = op == "hide_comment"
+            comment = self.comment_index.get(instance_id, {}).get(event["comment_id"])
+            if comment is None:
+                return None
+            was_hidden = comment.get("hidden", False)
+            comment["hidden"] = hidden
+            self.export_cache.pop(instance_id, None)
+            visible = self.visible_comments.setdefault(instance_id, deque())
+            if hidden and not was_hidden:
+                visible.remove(comment)
+            elif not hidden and was_hidden:
+                _insert_by_timestamp(visible, comment)
+            return comment
+        
+        if op == "update_settings":
+            self.settings[event["instance_id"]] = event["settings"]
+            self._settings_json.pop(event["instance_id"], None)
+            return event["settings"]
+        
+        if op == "set_history_limit":
+            instance_id = event["instance_id"]
+            if instance_id not in self.instances:
+                return None
+            self.instances[instance_id]["history_limit"] = event["history_limit"]
+            # 新しい上限で作り直す（上限を超える古いコメントは破棄される）
+            comments = deque(self.comments.get(instance_id, ()), maxlen=event["history_limit"])
+            self.comments[instance_id] = comments
+            self.visible_comments[instance_id] = self._filter_visible(comments)
+            self.comment_index[instance_id] = {c["id"]: c for c in comments}
+            self.export_cache.pop(instance_id, None)
+            return self.instances[instance_id]
+        
+        logger.warning(f"不明なWALイベントです: {op}")
+        return None
+
+    async def _record(self, event: Dict) -> Optional[Dict]:
+        """変更を反映してWALに追記"""
+        result = self._apply(event)
+        await self.wal.append(event)
+        return result
+        
+    async def create_instance(self, instance_id: str, name: str, webhook_url: Optional[str] = None, admin_password: Optional[str] = None):
+        await self._record({
+            "op": "create_instance",
+            "instance": {
+                "id": instance_id,
+                "name": name,
+                "webhook_url": webhook_url,
+                "admin_password": admin_password,
+                "created_at": datetime.now(JST).isoformat(),
+                "active": True
+            },
+            "settings": dict(DEFAULT_SETTINGS)
+        })
+
+    async def delete_instance(self, instance_id: str):
+        await self._record({"op": "delete_instance", "instance_id": instance_id})
+
+    async def add_comment(self, comment_data: Dict):
+        await self._record({"op": "new_comment", "comment": comment_data})
+
+    async def set_comment_hidden(self, instance_id: str, comment_id: str, hidden: bool) -> Optional[Dict]:
+        """コメントの表示状態を変更（見つからない場合はNone）"""
+        event = {
+            "op": "hide_comment" if hidden else "show_comment",
+            "instance_id": instance_id,
+            "comment_id": comment_id
         }
-        self.save_data()
+        comment = self._apply(event)
+        if comment is not None:
+            await self.wal.append(event)
+        return comment
+
+    def settings_json(self, instance_id: str) -> bytes:
+        """設定をJSONエンコードしたもの（古いデータで欠けている項目はデフォルト値で補う）"""
+        encoded = self._settings_json.get(instance_id)
+        if encoded is None:
+            settings = {**DEFAULT_SETTINGS, **self.settings.get(instance_id, {})}
+            encoded = orjson.dumps(settings)
+            self._settings_json[instance_id] = encoded
+        return encoded
+
+    def export_csv(self, instance_id: str) -> bytes:
+        """全コメントのCSV（次に変更されるまで再利用）"""
+        cache = self.export_cache.setdefault(instance_id, {})
+        if "csv" not in cache:
+            buffer = io.StringIO()
+            buffer.write("ID,Author,Content,Timestamp\n")
+            writer = csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator="\n")
+            writer.writerows(
+                [c["id"], c["author"], c["content"], c["timestamp"]]
+                for c in self.comments.get(instance_id, ())
+            )
+            cache["csv"] = buffer.getvalue().encode("utf-8")
+        return cache["csv"]
+
+    def export_comments_json(self, instance_id: str) -> bytes:
+        """全コメントのJSON配列（次に変更されるまで再利用）"""
+        cache = self.export_cache.setdefault(instance_id, {})
+        if "json" not in cache:
+            cache["json"] = orjson.dumps(list(self.comments.get(instance_id, ())))
+        return cache["json"]
+
+    async def update_settings(self, instance_id: str, settings: Dict):
+        await self._record({"op": "update_settings", "instance_id": instance_id, "settings": settings})
+
+    async def set_history_limit(self, instance_id: str, history_limit: int):
+        await self._record({"op": "set_history_limit", "instance_id": instance_id, "history_limit": history_limit})
 
 data_store = DataStore()
 
+@app.on_event("startup")
+async def startup():
+    await data_store.start()
+    await broadcaster.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await broadcaster.stop()
+    await data_store.stop()
+    await webhook_client.aclose()
+
 # Basic認証チェック関数
+def _basic_auth_password(request: Request) -> Optional[str]:
+    """Authorizationヘッダーからパスワードを取り出す（同じリクエスト内では結果を再利用）"""
+    if hasattr(request.state, "basic_auth_password"):
+        return request.state.basic_auth_password
+    
+    password = None
+    authorization = request.headers.get("Authorization")
+    if authorization and authorization.startswith("Basic "):
+        try:
+            # Base64デコード
+            encoded_credentials = authorization.split(" ")[1]
+            decoded_credentials = base64.b64decode(encoded_credentials).decode("utf-8")
+            
+            # ユーザー名:パスワードの形式をパース（ユーザー名は空でも可）
+            if ":" in decoded_credentials:
+                username, password = decoded_credentials.split(":", 1)
+            else:
+                # コロンがない場合はパスワードのみとして扱う
+                password = decoded_credentials
+        except (ValueError, UnicodeDecodeError):
+            password = None
+    
+    request.state.basic_auth_password = password
+    return password
+
 def check_admin_auth(instance_id: str, request: Request) -> bool:
     """管理画面のBasic認証をチェック"""
     if instance_id not in data_store.instances:
@@ -144,27 +519,29 @@ def check_admin_auth(instance_id: str, request: Request) -> bool:
     if not admin_password:
         return True
     
-    # Authorizationヘッダーを確認
-    authorization = request.headers.get("Authorization")
-    if not authorization or not authorization.startswith("Basic "):
-        return False
+    # 管理画面が送る形式（ユーザー名なし）はヘッダーをそのまま期待値と比較する
+    authorization = request.headers.get("Authorization", "").encode("latin-1")
+    if hmac.compare_digest(authorization, data_store.auth_tokens[instance_id]):
+        return True
     
-    try:
-        # Base64デコード
-        encoded_credentials = authorization.split(" ")[1]
-        decoded_credentials = base64.b64decode(encoded_credentials).decode("utf-8")
-        
-        # ユーザー名:パスワードの形式をパース（ユーザー名は空でも可）
-        if ":" in decoded_credentials:
-            username, password = decoded_credentials.split(":", 1)
-        else:
-            # コロンがない場合はパスワードのみとして扱う
-            password = decoded_credentials
-        
-        # パスワード確認（ユーザー名は無視）
-        return password == admin_password
-    except (ValueError, UnicodeDecodeError):
+    # それ以外の形式（ブラウザのダイアログでユーザー名を入力した場合など）はデコードして確認
+    # （ユーザー名は無視、比較時間は一定）
+    password = _basic_auth_password(request)
+    if password is None:
         return False
+    return hmac.compare_digest(password.encode("utf-8"), admin_password.encode("utf-8"))
+
+async def admin_auth(instance_id: str, request: Request):
+    """管理者用エンドポイントの依存関係（インスタンスの存在確認とBasic認証）"""
+    if instance_id not in data_store.instances:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    
+    if not check_admin_auth(instance_id, request):
+        raise HTTPException(
+            status_code=401, 
+            detail="Unauthorized",
+            headers={"WWW-Authenticate": "Basic"}
+        )
 
 # Pydantic モデル
 class CommentCreate(BaseModel):
@@ -194,6 +571,9 @@ class InstanceResponse(BaseModel):
     created_at: str
     active: bool
 
+class HistoryLimit(BaseModel):
+    history_limit: int = Field(..., ge=1)  # 保持するコメント数の上限
+
 class DisplaySettings(BaseModel):
     background_color: str = "#00FF00"
     text_color: str = "#000000"
@@ -209,6 +589,9 @@ class DisplaySettings(BaseModel):
     comment_background_color: str = "#FFFFFF"  # コメント背景色
     lag_seconds: int = 0  # コメント表示遅延秒数
 
+# 設定のデフォルト値（リクエストごとにモデルを生成しないよう一度だけ作成）
+DEFAULT_SETTINGS: Dict[str, Any] = DisplaySettings().model_dump()
+
 # Socket.IO イベント
 @sio.event
 async def connect(sid, environ):
@@ -217,23 +600,30 @@ async def connect(sid, environ):
 @sio.event
 async def disconnect(sid):
     logger.info(f"Client disconnected: {sid}")
+    for room in sid_rooms.pop(sid, ()):
+        sids = room_sids.get(room)
+        if sids is None:
+            continue
+        sids.discard(sid)
+        if not sids:
+            del room_sids[room]
 
 @sio.event
 async def join_instance(sid, data):
     instance_id = data.get('instance_id')
     if instance_id in data_store.instances:
         try:
-            await sio.enter_room(sid, instance_id)
+            sio.enter_room(sid, instance_id)
+            track_room(sid, instance_id)
             logger.info(f"Client {sid} joined instance {instance_id}")
             
             # 既存のコメントを送信（非表示でないもののみ）
-            all_comments = data_store.comments.get(instance_id, [])
-            visible_comments = [c for c in all_comments if not c.get('hidden', False)]
+            visible_comments = data_store.visible_comments.get(instance_id, [])
             logger.info(f"Sending {len(visible_comments)} initial comments to client {sid}")
-            await sio.emit('initial_comments', {'comments': visible_comments}, room=sid)
+            await sio.emit('initial_comments', {'comments': list(visible_comments)}, room=sid)
             
             # 設定も送信
-            settings = data_store.settings.get(instance_id, DisplaySettings().dict())
+            settings = data_store.settings.get(instance_id, DEFAULT_SETTINGS)
             await sio.emit('settings_updated', settings, room=sid)
             
         except Exception as e:
@@ -249,16 +639,17 @@ async def join_admin_instance(sid, data):
     instance_id = data.get('instance_id')
     if instance_id in data_store.instances:
         try:
-            await sio.enter_room(sid, f"admin_{instance_id}")
+            sio.enter_room(sid, f"admin_{instance_id}")
+            track_room(sid, f"admin_{instance_id}")
             logger.info(f"Admin client {sid} joined instance {instance_id}")
             
             # 管理者には全コメント（非表示も含む）を送信
             all_comments = data_store.comments.get(instance_id, [])
             logger.info(f"Sending {len(all_comments)} admin comments to client {sid}")
-            await sio.emit('initial_admin_comments', {'comments': all_comments}, room=sid)
+            await sio.emit('initial_admin_comments', {'comments': list(all_comments)}, room=sid)
             
             # 設定も送信
-            settings = data_store.settings.get(instance_id, DisplaySettings().dict())
+            settings = data_store.settings.get(instance_id, DEFAULT_SETTINGS)
             await sio.emit('settings_updated', settings, room=sid)
             
         except Exception as e:
@@ -276,12 +667,12 @@ async def root():
 @app.post("/instances/", response_model=InstanceResponse)
 async def create_instance(instance: InstanceCreate):
     instance_id = str(uuid.uuid4())
-    data_store.create_instance(instance_id, instance.name, instance.webhook_url, instance.admin_password)
+    await data_store.create_instance(instance_id, instance.name, instance.webhook_url, instance.admin_password)
     return data_store.instances[instance_id]
 
-@app.get("/instances/", response_model=List[InstanceResponse])
+@app.get("/instances/", responses={200: {"model": List[InstanceResponse]}})
 async def get_instances():
-    return list(data_store.instances.values())
+    return ORJSONResponse(content=list(data_store.instances.values()))
 
 @app.get("/instances/{instance_id}/", response_model=InstanceResponse)
 async def get_instance(instance_id: str):
@@ -289,68 +680,32 @@ async def get_instance(instance_id: str):
         raise HTTPException(status_code=404, detail="Instance not found")
     return data_store.instances[instance_id]
 
-@app.get("/admin/instance/{instance_id}/", response_model=InstanceResponse)
-async def get_admin_instance(instance_id: str, request: Request):
-    if instance_id not in data_store.instances:
-        raise HTTPException(status_code=404, detail="Instance not found")
-    
-    # Basic認証チェック
-    if not check_admin_auth(instance_id, request):
-        raise HTTPException(
-            status_code=401, 
-            detail="Unauthorized",
-            headers={"WWW-Authenticate": "Basic"}
-        )
-    
+@app.get("/admin/instance/{instance_id}/", response_model=InstanceResponse, dependencies=[Depends(admin_auth)])
+async def get_admin_instance(instance_id: str):
     return data_store.instances[instance_id]
 
-@app.get("/admin/auth/{instance_id}/")
-async def check_admin_auth_endpoint(instance_id: str, request: Request):
+@app.get("/admin/auth/{instance_id}/", dependencies=[Depends(admin_auth)])
+async def check_admin_auth_endpoint(instance_id: str):
     """管理者認証チェック用エンドポイント"""
-    if instance_id not in data_store.instances:
-        raise HTTPException(status_code=404, detail="Instance not found")
-    
     # パスワードが設定されていない場合は認証不要
     admin_password = data_store.instances[instance_id].get('admin_password')
-    if not admin_password:
-        return {"auth_required": False, "authenticated": True}
-    
-    # Basic認証チェック
-    if not check_admin_auth(instance_id, request):
-        raise HTTPException(
-            status_code=401, 
-            detail="Unauthorized",
-            headers={"WWW-Authenticate": "Basic"}
-        )
-    
-    return {"auth_required": True, "authenticated": True}
+    return {"auth_required": bool(admin_password), "authenticated": True}
 
 @app.delete("/instances/{instance_id}/")
 async def delete_instance(instance_id: str):
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
     
-    # インスタンスデータを削除
-    del data_store.instances[instance_id]
-    
-    # 関連するコメントを削除
-    if instance_id in data_store.comments:
-        del data_store.comments[instance_id]
-    
-    # 関連する設定を削除
-    if instance_id in data_store.settings:
-        del data_store.settings[instance_id]
-    
-    # データを永続化
-    data_store.save_data()
+    # インスタンスと関連するコメント・設定を削除
+    await data_store.delete_instance(instance_id)
     
     # Socket.IOルームからすべてのクライアントを削除
-    await sio.emit('instance_deleted', {}, room=instance_id)
+    await emit_to_room('instance_deleted', {}, instance_id)
     
     return {"message": "Instance deleted successfully"}
 
 @app.post("/comments/", response_model=CommentResponse)
-async def create_comment(comment: CommentCreate):
+async def create_comment(comment: CommentCreate, background_tasks: BackgroundTasks):
     if comment.instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
         
@@ -365,109 +720,78 @@ async def create_comment(comment: CommentCreate):
         "hidden": False
     }
     
-    # コメントを保存（制限なし）
-    data_store.comments[comment.instance_id].append(comment_data)
+    # コメントを保存（保持上限を超えた古いコメントは破棄される）
+    await data_store.add_comment(comment_data)
     
-    # データを永続化
-    data_store.save_data()
+    # Socket.IO で新しいコメントを配信（一般ユーザー用と管理者用の両方、まとめて送信）
+    broadcaster.add(comment.instance_id, comment_data)
     
-    # Socket.IO で新しいコメントを配信（一般ユーザー用と管理者用の両方）
-    await sio.emit('new_comment', comment_data, room=comment.instance_id)
-    await sio.emit('new_comment', comment_data, room=f"admin_{comment.instance_id}")
-    
-    # Webhook通知（設定されている場合）
+    # Webhook通知（設定されている場合、レスポンス送信後にバックグラウンドで実行）
     instance = data_store.instances[comment.instance_id]
     if instance.get('webhook_url'):
-        # ここでWebhook通知を実装
-        logger.info(f"Webhook notification would be sent to {instance['webhook_url']}")
+        background_tasks.add_task(send_webhook, instance['webhook_url'], comment_data)
     
     return comment_data
 
-@app.get("/comments/{instance_id}/", response_model=List[CommentResponse])
+@app.get("/comments/{instance_id}/", responses={200: {"model": List[CommentResponse]}})
 async def get_comments(instance_id: str):
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
     
     # 非表示でないコメントのみを返す
-    all_comments = data_store.comments.get(instance_id, [])
-    visible_comments = [c for c in all_comments if not c.get('hidden', False)]
-    return visible_comments
+    visible_comments = data_store.visible_comments.get(instance_id, [])
+    # サーバーで生成したデータなのでレスポンスモデルでの再検証は行わない
+    return ORJSONResponse(content=list(visible_comments))
 
-@app.get("/admin/comments/{instance_id}/", response_model=List[CommentResponse])
-async def get_admin_comments(instance_id: str, request: Request):
-    if instance_id not in data_store.instances:
-        raise HTTPException(status_code=404, detail="Instance not found")
-    
-    # Basic認証チェック
-    if not check_admin_auth(instance_id, request):
-        raise HTTPException(
-            status_code=401, 
-            detail="Unauthorized",
-            headers={"WWW-Authenticate": "Basic"}
-        )
-    
+@app.get("/admin/comments/{instance_id}/", responses={200: {"model": List[CommentResponse]}}, dependencies=[Depends(admin_auth)])
+async def get_admin_comments(instance_id: str):
     # 管理者は全コメント（非表示も含む）を取得
-    return data_store.comments.get(instance_id, [])
+    return ORJSONResponse(content=list(data_store.comments.get(instance_id, ())))
 
 @app.put("/settings/{instance_id}/", response_model=DisplaySettings)
 async def update_settings(instance_id: str, settings: DisplaySettings):
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
     
-    data_store.settings[instance_id] = settings.dict()
-    
-    # データを永続化
-    data_store.save_data()
+    dumped = settings.model_dump()
+    await data_store.update_settings(instance_id, dumped)
     
     # Socket.IO で設定更新を配信
-    await sio.emit('settings_updated', settings.dict(), room=instance_id)
+    await emit_to_room('settings_updated', dumped, instance_id)
     
-    return settings
+    return Response(content=data_store.settings_json(instance_id), media_type="application/json")
 
-@app.get("/settings/{instance_id}/", response_model=DisplaySettings)
-async def get_settings(instance_id: str):
+@app.put("/settings/{instance_id}/history_limit", response_model=HistoryLimit)
+async def update_history_limit(instance_id: str, limit: HistoryLimit):
+    """保持するコメント数の上限を変更"""
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
-    return data_store.settings.get(instance_id, DisplaySettings().dict())
+    
+    await data_store.set_history_limit(instance_id, limit.history_limit)
+    
+    return limit
 
-@app.get("/admin/settings/{instance_id}/", response_model=DisplaySettings)
-async def get_admin_settings(instance_id: str, request: Request):
+@app.get("/settings/{instance_id}/", response_model=DisplaySettings)
+async def get_settings(instance_id: str):
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
-    
-    # Basic認証チェック
-    if not check_admin_auth(instance_id, request):
-        raise HTTPException(
-            status_code=401, 
-            detail="Unauthorized",
-            headers={"WWW-Authenticate": "Basic"}
-        )
-    
-    return data_store.settings.get(instance_id, DisplaySettings().dict())
+    return Response(content=data_store.settings_json(instance_id), media_type="application/json")
+
+@app.get("/admin/settings/{instance_id}/", response_model=DisplaySettings, dependencies=[Depends(admin_auth)])
+async def get_admin_settings(instance_id: str):
+    return Response(content=data_store.settings_json(instance_id), media_type="application/json")
 
 @app.put("/comments/{instance_id}/{comment_id}/hide")
 async def hide_comment(instance_id: str, comment_id: str):
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
     
-    comments = data_store.comments.get(instance_id, [])
-    comment_found = False
-    
-    for comment in comments:
-        if comment['id'] == comment_id:
-            comment['hidden'] = True
-            comment_found = True
-            break
-    
-    if not comment_found:
+    comment = await data_store.set_comment_hidden(instance_id, comment_id, True)
+    if comment is None:
         raise HTTPException(status_code=404, detail="Comment not found")
     
-    # データを永続化
-    data_store.save_data()
-    
     # Socket.IO で非表示を配信（一般ユーザー用と管理者用の両方）
-    await sio.emit('comment_hidden', {'comment_id': comment_id}, room=instance_id)
-    await sio.emit('comment_hidden', {'comment_id': comment_id}, room=f"admin_{instance_id}")
+    await emit_to_room('comment_hidden', {'comment_id': comment_id}, instance_rooms(instance_id))
     
     return {"message": "Comment hidden"}
 
@@ -476,32 +800,15 @@ async def show_comment(instance_id: str, comment_id: str):
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
     
-    comments = data_store.comments.get(instance_id, [])
-    comment_found = False
-    comment_data = None
-    
-    for comment in comments:
-        if comment['id'] == comment_id:
-            comment['hidden'] = False
-            comment_found = True
-            comment_data = comment
-            break
-    
-    if not comment_found:
+    comment_data = await data_store.set_comment_hidden(instance_id, comment_id, False)
+    if comment_data is None:
         raise HTTPException(status_code=404, detail="Comment not found")
     
-    # データを永続化
-    data_store.save_data()
-    
     # Socket.IO で表示復帰を配信（一般ユーザー用と管理者用の両方）
-    await sio.emit('comment_shown', {
-        'comment_id': comment_id, 
-        'comment': comment_data
-    }, room=instance_id)
-    await sio.emit('comment_shown', {
+    await emit_to_room('comment_shown', {
         'comment_id': comment_id, 
         'comment': comment_data
-    }, room=f"admin_{instance_id}")
+    }, instance_rooms(instance_id))
     
     return {"message": "Comment shown"}
 
@@ -515,7 +822,7 @@ async def webhook_endpoint(instance_id: str, data: Dict[str, Any]):
     logger.info(f"Webhook received for instance {instance_id}: {data}")
     
     # Socket.IO でWebhookデータを配信
-    await sio.emit('webhook_received', data, room=instance_id)
+    await emit_to_room('webhook_received', data, instance_id)
     
     return {"status": "received"}
 
@@ -525,16 +832,17 @@ async def export_comments_json(instance_id: str):
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
     
-    comments = data_store.comments.get(instance_id, [])
-    instance_data = {
+    instance_data = orjson.dumps({
         "instance_id": instance_id,
         "instance_name": data_store.instances[instance_id]["name"],
-        "export_date": datetime.now(JST).isoformat(),
-        "comments": comments
-    }
+        "export_date": datetime.now(JST).isoformat()
+    })
+    # エンコード済みのコメント一覧をそのまま埋め込む
+    content = instance_data[:-1] + b',"comments":' + data_store.export_comments_json(instance_id) + b'}'
     
-    return JSONResponse(
-        content=instance_data,
+    return Response(
+        content=content,
+        media_type="application/json",
         headers={
             "Content-Disposition": f"attachment; filename=comments_{instance_id}.json"
         }
@@ -545,18 +853,8 @@ async def export_comments_csv(instance_id: str):
     if instance_id not in data_store.instances:
         raise HTTPException(status_code=404, detail="Instance not found")
     
-    comments = data_store.comments.get(instance_id, [])
-    
-    # CSV形式のデータを作成
-    csv_data = "ID,Author,Content,Timestamp\n"
-    for comment in comments:
-        # CSVエスケープ処理
-        author = comment['author'].replace('"', '""')
-        content = comment['content'].replace('"', '""')
-        csv_data += f'"{comment["id"]}","{author}","{content}","{comment["timestamp"]}"\n'
-    
     return Response(
-        content=csv_data,
+        content=data_store.export_csv(instance_id),
         media_type="text/csv",
         headers={
             "Content-Disposition": f"attachment; filename=comments_{instance_id}.csv"
@@ -566,4 +864,6 @@ async def export_comments_csv(instance_id: str):
 if __name__ == "__main__":
     import uvicorn
     # Socket.IOアプリケーションとして起動
-    uvicorn.run("main:socket_app", host="0.0.0.0", port=8880, reload=True)
+    # uvloop / httptools がインストールされていれば自動的に使われる（uvicorn[standard]）
+    # データはプロセス内に保持しているため、ワーカーは1つで動かす
+    uvicorn.run("main:socket_app", host="0.0.0.0", port=8880, reload=DEBUG, workers=1)
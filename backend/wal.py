@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+import aiofiles
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+# 追記専用の変更ログ（Write-Ahead Log）
+class WriteAheadLog:
+    """変更イベントを1行1JSONで追記し、短い間隔でまとめて書き込み・fsyncする"""
+
+    def __init__(self, path: Path, flush_interval: float = 0.05, max_batch: int = 100):
+        self.path = path
+        self.flush_interval = flush_interval  # 書き込みをまとめる最大待ち時間（秒）
+        self.max_batch = max_batch  # この件数に達したら待たずに書き込む
+        self._buffer: List[bytes] = []
+        self._events_since_checkpoint = 0
+        self._file = None
+        self._task: Optional[asyncio.Task] = None
+        # イベントループ起動後に作成する（Python 3.9ではループに紐付くため）
+        self._lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def replay(self) -> List[dict]:
+        """前回のスナップショット以降に記録されたイベントを読み出す"""
+        events = []
+        if not self.path.exists():
+            return events
+
+        with open(self.path, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    events.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # 書き込み途中で停止した末尾行は破棄する
+                    logger.warning("WALの不完全な行をスキップしました")
+                    break
+
+        self._events_since_checkpoint = len(events)
+        return events
+
+    async def start(self):
+        """ログファイルを開き、書き込みタスクを開始"""
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._file = await aiofiles.open(self.path, 'ab')
+        self._task = asyncio.create_task(self._run())
+
+    async def append(self, event: dict):
+        """イベントを追記キューに積む（実際の書き込みはバックグラウンドでまとめて行う）"""
+        self._buffer.append(orjson.dumps(event) + b"\n")
+        self._events_since_checkpoint += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # 短い待ち時間の間に届いたイベントを1回の書き込みにまとめる
+            if len(self._buffer) < self.max_batch:
+                await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"WAL書き込みエラー: {e}")
+
+    async def flush(self):
+        """溜まっているイベントを書き込み、fsyncする"""
+        async with self._lock:
+            self._wakeup.clear()
+            if not self._buffer:
+                return
+            lines, self._buffer = self._buffer, []
+            await self._file.write(b"".join(lines))
+            await self._file.flush()
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+
+    async def checkpoint(self, snapshot: Callable[[], Awaitable[None]]):
+        """スナップショットを書き出し、ログを切り詰める"""
+        async with self._lock:
+            if not self._events_since_checkpoint:
+                return
+            # 未書き込みのイベントは既にメモリ上のデータに反映済みのため、
+            # スナップショットに含まれる。ログには書かずに破棄する
+            # （snapshotは最初のawaitより前にデータを直列化しておくこと）
+            dropped, self._buffer = self._buffer, []
+            covered = self._events_since_checkpoint
+            try:
+                await snapshot()
+            except Exception:
+                # 保存に失敗した場合は破棄したイベントを書き込み待ちに戻す
+                self._buffer = dropped + self._buffer
+                raise
+            await self._file.truncate(0)
+            # スナップショット書き出し中に追加されたイベントは次回の対象にする
+            self._events_since_checkpoint -= covered
+
+    async def close(self):
+        """書き込みタスクを停止し、残りを書き込んでファイルを閉じる"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._file is not None:
+            await self.flush()
+            await self._file.close()
+            self._file = None
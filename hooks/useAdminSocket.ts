@@ -31,6 +31,10 @@ export const useAdminSocket = (instanceId?: string, authHeader?: string) => {
       setAllComments(prev => [...prev, comment]);
     });
 
+    newSocket.on('new_comments', (newComments: Comment[]) => {
+      setAllComments(prev => [...prev, ...newComments]);
+    });
+
     newSocket.on('initial_admin_comments', (data: { comments: Comment[] }) => {
       setAllComments(data.comments);
       // フォールバックタイマーをクリア
@@ -32,6 +32,11 @@ export const useSocket = (instanceId?: string) => {
       setComments(prev => [...prev, comment]);
     });
 
+    newSocket.on('new_comments', (newComments: Comment[]) => {
+      // 短時間に届いたコメントはまとめて配信される
+      setComments(prev => [...prev, ...newComments]);
+    });
+
     newSocket.on('initial_comments', (data: { comments: Comment[] }) => {
       setComments(data.comments);
       // フォールバックタイマーをクリア